@@ -1,30 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
-from src.api_client import search_food, get_food_details
+from src.api_client import search_food, get_food_details, get_food_details_batch
 from src.ml.recommendation_engine import RecommendationEngine
 
 # Set page configuration
 st.set_page_config(page_title="Gym Nutrition Tracker")
 
+# Path to the Swiss Food Composition Database
+DATA_FILEPATH = 'data/Swiss_food_composition_database.xlsx'
+
 # Cached Model Loading
-# Note: Cache key includes version to force reload when code changes
-@st.cache_resource
-def load_engine(version: str = "v2"):
+# Note: Cache key includes the data file's mtime so the engine reloads when the file changes;
+# a single entry means the engine for an outdated file is released on reload
+@st.cache_resource(max_entries=1)
+def load_engine(data_filepath: str, data_mtime: float):
     try:
-        engine = RecommendationEngine(data_filepath='data/Swiss_food_composition_database.xlsx')
+        engine = RecommendationEngine(data_filepath)
         return engine
     except Exception as e:
         st.error(f"Error loading recommendation engine: {str(e)}")
         return None
 
+# Cached Recommendations
+# Macro keys in the order used for the cache-key tuples below
+MACRO_KEYS = ('kcal', 'protein', 'carbs', 'fat')
+
+# The engine argument is not hashed (leading underscore); data_mtime, the same key
+# load_engine uses, ties each cached result to the engine built from that data file
+@st.cache_data(max_entries=128, show_spinner=False)
+def cached_goal_aligned_foods(_engine: RecommendationEngine, data_mtime: float, remaining: tuple, goals: tuple, n_recommendations: int):
+    return _engine.get_goal_aligned_foods(
+        dict(zip(MACRO_KEYS, remaining)),
+        user_goals=dict(zip(MACRO_KEYS, goals)),
+        n_recommendations=n_recommendations
+    )
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def cached_similar_foods(_engine: RecommendationEngine, data_mtime: float, food_name: str, n_recommendations: int):
+    return _engine.get_similar_foods(food_name, n_recommendations=n_recommendations)
+
+# Cached FSVO API Lookups
+# Queries are normalized so case/whitespace variants share one cache entry.
+# Failed searches raise instead of returning [], so the empty result is not
+# cached and the next rerun retries the API
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _cached_search(query: str) -> list[dict]:
+    return search_food(query, raise_on_error=True)
+
+# Nutrient data is static on a day scale, so details are kept for 24h per dbid
+@st.cache_data(ttl=86400, max_entries=2048, show_spinner=False)
+def _cached_details(dbid: int) -> dict:
+    food_details = get_food_details(dbid)
+    if food_details is None:
+        # Raising keeps failed lookups out of the cache so they are retried next time
+        raise LookupError("Could not fetch nutritional data for this food.")
+    return food_details
+
+# Background Prefetching
+# Number of top search hits whose details are fetched ahead of the Log Food submit
+PREFETCH_TOP_K = 4
+
+# One shared background thread for the whole server process; each prefetch
+# fans out over the API client's own worker pool
+@st.cache_resource
+def _prefetch_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+
+# Cached per tuple of dbids so reruns of the same search don't resubmit work
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def _prefetch_details(dbids: tuple[int, ...]) -> None:
+    # Fire and forget: results land in the API client's details cache, so the
+    # later _cached_details call for a prefetched food needs no network round-trip
+    _prefetch_executor().submit(get_food_details_batch, list(dbids))
+
 # Load the recommendation engine (cached)
-# Increment version string to force cache refresh when engine code changes
-engine = load_engine(version="v2_fixed")
+# A missing file still goes through load_engine so the error is reported in the UI
+data_mtime = os.path.getmtime(DATA_FILEPATH) if os.path.exists(DATA_FILEPATH) else 0.0
+engine = load_engine(DATA_FILEPATH, data_mtime)
 
 # Main title
 st.title("Gym Nutrition Tracker")
 
+# Meal Log State
+# Initialized before the search section, whose Log Food form appends to the log
+# Check if 'logged_meals' is not in session state, initialize as empty list
+if 'logged_meals' not in st.session_state:
+    st.session_state.logged_meals = []
+
+# Running totals of consumed macros, updated whenever a meal is logged; seeded from
+# the log so sessions that already have meals start with matching totals
+if 'totals' not in st.session_state:
+    st.session_state.totals = {
+        macro: sum(meal[macro] for meal in st.session_state.logged_meals)
+        for macro in MACRO_KEYS
+    }
+
 # Food Logging Section - Moved to top for better UX
 st.header("Log a Meal")
 
@@ -40,18 +113,48 @@ search_query = st.text_input(
 if 'search_results' not in st.session_state:
     st.session_state.search_results = []
 
+# Remember which query the stored results belong to
+if 'last_query' not in st.session_state:
+    st.session_state.last_query = None
+
+# Index of the stored results by food name for O(1) selection lookups
+if 'name_to_food' not in st.session_state:
+    st.session_state.name_to_food = {}
+
+# Selectbox options for the stored results, built once per query
+if 'food_names' not in st.session_state:
+    st.session_state.food_names = []
+
+normalized_query = search_query.strip().lower()
+
 # When query is not empty, call search_food
 if search_query:
     try:
-        # Call search_food API
-        search_results = search_food(search_query)
+        # Only call the API when the query changed since the last search;
+        # reruns triggered by other widgets reuse the stored results
+        if normalized_query != st.session_state.last_query:
+            # Call search_food API (cached per normalized query); on failure it raises,
+            # so last_query below is only stored after a successful search
+            st.session_state.search_results = _cached_search(normalized_query)
+            # Keep the first result for duplicate names, as the selectbox shows it first
+            name_to_food = {}
+            for food in st.session_state.search_results:
+                name_to_food.setdefault(food['name'], food)
+            st.session_state.name_to_food = name_to_food
+            st.session_state.food_names = list(name_to_food.keys())
+            st.session_state.last_query = normalized_query
+            
+            # Warm the details cache for the most likely selections while the user reads
+            _prefetch_details(tuple(
+                food['dbid'] for food in st.session_state.search_results[:PREFETCH_TOP_K]
+            ))
+        
+        search_results = st.session_state.search_results
+        name_to_food = st.session_state.name_to_food
         
         if search_results:
-            # Store results in session state
-            st.session_state.search_results = search_results
-            
-            # Extract food names for selectbox
-            food_names = [food['name'] for food in search_results]
+            # Food names for selectbox, in search result order
+            food_names = st.session_state.food_names
             
             # Display selectbox with food names
             selected_food_name = st.selectbox(
@@ -61,10 +164,7 @@ if search_query:
             )
             
             # Find the dbid of the selected food
-            selected_food = next(
-                (food for food in search_results if food['name'] == selected_food_name),
-                None
-            )
+            selected_food = name_to_food.get(selected_food_name)
             
             if selected_food:
                 # Logging Form
@@ -88,10 +188,13 @@ if search_query:
                         # Get the dbid of the selected food
                         food_dbid = selected_food['dbid']
                         
-                        # Call get_food_details to fetch nutritional information
+                        # Call get_food_details to fetch nutritional information (cached per dbid)
+                        try:
+                            food_details = _cached_details(food_dbid)
+                        except LookupError:
+                            food_details = None
+                        
                         try:
-                            food_details = get_food_details(food_dbid)
-                            
                             if food_details:
                                 # Calculate consumed macros based on portion size
                                 # API returns macros per 100g, so: (portion / 100) * macro_per_100g
@@ -115,6 +218,11 @@ if search_query:
                                 # Append to logged_meals
                                 st.session_state.logged_meals.append(logged_meal)
                                 
+                                # Update running totals so the dashboard never re-sums the log
+                                totals = st.session_state.totals
+                                for macro in ('kcal', 'protein', 'carbs', 'fat'):
+                                    totals[macro] = totals.get(macro, 0) + logged_meal[macro]
+                                
                                 # Show success message
                                 st.success(f"Successfully logged {portion_size:.1f}g of {selected_food_name}!")
                                 
@@ -129,15 +237,19 @@ if search_query:
         else:
             # No results found
             st.info("No food found. Try a different search term.")
-            # Clear search results
-            st.session_state.search_results = []
     except Exception as e:
         # Handle search errors
         st.error(f"Error searching for food: {str(e)}")
         st.session_state.search_results = []
+        st.session_state.name_to_food = {}
+        st.session_state.food_names = []
+        st.session_state.last_query = None
 else:
     # Clear search results when query is empty
     st.session_state.search_results = []
+    st.session_state.name_to_food = {}
+    st.session_state.food_names = []
+    st.session_state.last_query = None
     st.info("Enter a food name above to search and log meals.")
 
 st.divider()
@@ -152,52 +264,37 @@ if 'user_goals' not in st.session_state:
         'fat': 60
     }
 
-# Check if 'logged_meals' is not in session state, initialize as empty list
-if 'logged_meals' not in st.session_state:
-    st.session_state.logged_meals = []
-
 # Goal Setting UI in Sidebar
 with st.sidebar:
     st.header("Set Your Daily Goals")
     
     # Create a form for goal setting
     with st.form(key='goal_form'):
-        # Number inputs for each macro goal
+        # A single editable row holds all four macro goals
         # Get current values from session state
-        kcal_goal = st.number_input(
-            'Calories (kcal)',
-            min_value=0,
-            max_value=10000,
-            value=st.session_state.user_goals['kcal'],
-            step=50,
-            help="Set your daily calorie target"
-        )
-        
-        protein_goal = st.number_input(
-            'Protein (g)',
-            min_value=0,
-            max_value=500,
-            value=st.session_state.user_goals['protein'],
-            step=5,
-            help="Set your daily protein target in grams"
-        )
-        
-        carbs_goal = st.number_input(
-            'Carbs (g)',
-            min_value=0,
-            max_value=1000,
-            value=st.session_state.user_goals['carbs'],
-            step=10,
-            help="Set your daily carbohydrate target in grams"
-        )
-        
-        fat_goal = st.number_input(
-            'Fat (g)',
-            min_value=0,
-            max_value=500,
-            value=st.session_state.user_goals['fat'],
-            step=5,
-            help="Set your daily fat target in grams"
+        edited_goals = st.data_editor(
+            pd.DataFrame([st.session_state.user_goals]),
+            num_rows="fixed",
+            hide_index=True,
+            use_container_width=True,
+            column_config={
+                'kcal': st.column_config.NumberColumn(
+                    'Calories (kcal)', min_value=0, max_value=10000, step=50, required=True,
+                    help="Set your daily calorie target"
+                ),
+                'protein': st.column_config.NumberColumn(
+                    'Protein (g)', min_value=0, max_value=500, step=5, required=True,
+                    help="Set your daily protein target in grams"
+                ),
+                'carbs': st.column_config.NumberColumn(
+                    'Carbs (g)', min_value=0, max_value=1000, step=10, required=True,
+                    help="Set your daily carbohydrate target in grams"
+                ),
+                'fat': st.column_config.NumberColumn(
+                    'Fat (g)', min_value=0, max_value=500, step=5, required=True,
+                    help="Set your daily fat target in grams"
+                )
+            }
         )
         
         # Submit button
@@ -206,81 +303,49 @@ with st.sidebar:
         # If button is clicked, update session state
         if submitted:
             st.session_state.user_goals = {
-                'kcal': int(kcal_goal),
-                'protein': int(protein_goal),
-                'carbs': int(carbs_goal),
-                'fat': int(fat_goal)
+                macro: int(edited_goals.iloc[0][macro])
+                for macro in ('kcal', 'protein', 'carbs', 'fat')
             }
             st.success("Goals updated successfully!")
 
-# Dashboard Visualization Section
-st.header("Today's Progress")
-
-# Calculate Totals
-# Check if logged_meals is not empty
-if st.session_state.logged_meals:
-    # Create a pandas DataFrame from the list of logged meal dictionaries
-    df_logged = pd.DataFrame(st.session_state.logged_meals)
-    
-    # Calculate the sum of consumed macros
-    total_kcal = df_logged['kcal'].sum() if 'kcal' in df_logged.columns else 0
-    total_protein = df_logged['protein'].sum() if 'protein' in df_logged.columns else 0
-    total_carbs = df_logged['carbs'].sum() if 'carbs' in df_logged.columns else 0
-    total_fat = df_logged['fat'].sum() if 'fat' in df_logged.columns else 0
-else:
-    # If no meals, totals should be 0
-    total_kcal = 0
-    total_protein = 0
-    total_carbs = 0
-    total_fat = 0
+# Read Totals
+# Totals are maintained incrementally at log time (0 when nothing is logged)
+total_kcal = st.session_state.totals['kcal']
+total_protein = st.session_state.totals['protein']
+total_carbs = st.session_state.totals['carbs']
+total_fat = st.session_state.totals['fat']
 
 # Display Progress Bars
-# Helper function to display progress for each macro
-def display_progress_bar(macro_name: str, consumed: float, target: float, unit: str = ""):
-    st.write(f"**{macro_name}**")
-    
-    # Calculate progress percentage, cap at 1.0 to prevent overflow
-    if target > 0:
-        progress = min(consumed / target, 1.0)
-    else:
-        progress = 0.0
-    
-    # Display progress bar
-    st.progress(progress)
-    
-    # Calculate remaining
-    remaining = max(target - consumed, 0)
-    
-    # Display remaining text
-    st.markdown(f"Remaining: {remaining:.1f} {unit}")
-    
-    # Display consumed/target info
-    st.caption(f"Consumed: {consumed:.1f} / {target:.1f} {unit}")
-
-# Display progress bars in a 2x2 grid layout for better UX
-col1, col2 = st.columns(2)
-
-with col1:
-    display_progress_bar("Calories", total_kcal, st.session_state.user_goals['kcal'], "kcal")
-
-with col2:
-    display_progress_bar("Protein", total_protein, st.session_state.user_goals['protein'], "g")
-
-col3, col4 = st.columns(2)
-
-with col3:
-    display_progress_bar("Carbs", total_carbs, st.session_state.user_goals['carbs'], "g")
-
-with col4:
-    display_progress_bar("Fat", total_fat, st.session_state.user_goals['fat'], "g")
-
-# Display Pie Chart
-st.header("Macro Distribution")
-
-# Check if total grams of P+F+C are greater than zero
-total_macros_g = total_protein + total_carbs + total_fat
+# Helper function to build the progress markup for all macros at once, so the
+# whole block is sent to the browser as a single element
+def progress_bars_html(rows: list[tuple[str, float, float, str]]) -> str:
+    blocks = []
+    for macro_name, consumed, target, unit in rows:
+        # Calculate progress percentage, cap at 1.0 to prevent overflow
+        if target > 0:
+            progress = min(consumed / target, 1.0)
+        else:
+            progress = 0.0
+        
+        # Calculate remaining
+        remaining = max(target - consumed, 0)
+        
+        blocks.append(
+            f"<div style='margin-bottom: 1rem'>"
+            f"<b>{macro_name}</b><br>"
+            f"<progress value='{progress:.4f}' max='1' style='width: 100%'></progress>"
+            f"<div>Remaining: {remaining:.1f} {unit}</div>"
+            f"<small>Consumed: {consumed:.1f} / {target:.1f} {unit}</small>"
+            f"</div>"
+        )
+    return "".join(blocks)
 
-if total_macros_g > 0:
+# Cached Pie Chart Factory
+# Identical totals return the cached figure instead of rebuilding it
+@st.cache_data(max_entries=64, show_spinner=False)
+def macro_pie_figure(total_protein: float, total_carbs: float, total_fat: float) -> go.Figure:
+    total_macros_g = total_protein + total_carbs + total_fat
+    
     # Create a Plotly pie chart showing the distribution of consumed macros
     fig = go.Figure(data=[go.Pie(
         labels=['Protein', 'Carbs', 'Fat'],
@@ -295,11 +360,41 @@ if total_macros_g > 0:
         annotations=[dict(text=f'{total_macros_g:.1f}g<br>Total', x=0.5, y=0.5, font_size=16, showarrow=False)]
     )
     
-    # Display the chart
-    st.plotly_chart(fig, use_container_width=True)
-else:
-    # If no macros have been logged, display a message
-    st.info("Log a meal to see your macro distribution.")
+    return fig
+
+# Dashboard Visualization Section
+def render_dashboard(total_kcal: float, total_protein: float, total_carbs: float, total_fat: float):
+    st.header("Today's Progress")
+    
+    # Display all progress bars as one pre-rendered HTML block
+    goals = st.session_state.user_goals
+    st.markdown(
+        progress_bars_html([
+            ("Calories", total_kcal, goals['kcal'], "kcal"),
+            ("Protein", total_protein, goals['protein'], "g"),
+            ("Carbs", total_carbs, goals['carbs'], "g"),
+            ("Fat", total_fat, goals['fat'], "g"),
+        ]),
+        unsafe_allow_html=True
+    )
+    
+    # Display Pie Chart
+    st.header("Macro Distribution")
+    
+    # Check if total grams of P+F+C are greater than zero
+    total_macros_g = total_protein + total_carbs + total_fat
+    
+    if total_macros_g > 0:
+        # Round to 0.1g so floating-point noise doesn't cause cache misses
+        fig = macro_pie_figure(round(total_protein, 1), round(total_carbs, 1), round(total_fat, 1))
+        
+        # Display the chart
+        st.plotly_chart(fig, use_container_width=True)
+    else:
+        # If no macros have been logged, display a message
+        st.info("Log a meal to see your macro distribution.")
+
+render_dashboard(total_kcal, total_protein, total_carbs, total_fat)
 
 # AI Recommendations Section
 st.header("AI Recommendations")
@@ -325,18 +420,20 @@ else:
         if sum(remaining_macros.values()) > 0:
             try:
                 # Call get_goal_aligned_foods with user goals for completion percentage calculation
-                goal_aligned_foods = engine.get_goal_aligned_foods(
-                    remaining_macros, 
-                    user_goals=st.session_state.user_goals,
+                # Inputs are rounded to 0.1 so repeated clicks with unchanged totals hit the cache
+                goal_aligned_foods = cached_goal_aligned_foods(
+                    engine,
+                    data_mtime,
+                    tuple(round(remaining_macros[macro], 1) for macro in MACRO_KEYS),
+                    tuple(st.session_state.user_goals[macro] for macro in MACRO_KEYS),
                     n_recommendations=5
                 )
                 
                 if not goal_aligned_foods.empty:
                     # Display results in a dataframe
-                    # Select relevant columns for display
-                    display_columns = ['Name', 'Category', 'kcal', 'protein', 'fat', 'carbs']
+                    # The engine already returns only the display columns
                     st.dataframe(
-                        goal_aligned_foods[display_columns],
+                        goal_aligned_foods,
                         use_container_width=True,
                         hide_index=True
                     )
@@ -356,15 +453,14 @@ else:
             last_logged_food_name = st.session_state.logged_meals[-1]['name']
             
             try:
-                # Call get_similar_foods
-                similar_foods = engine.get_similar_foods(last_logged_food_name, n_recommendations=5)
+                # Call get_similar_foods (cached per food name)
+                similar_foods = cached_similar_foods(engine, data_mtime, last_logged_food_name, n_recommendations=5)
                 
                 if not similar_foods.empty:
                     # Display results in a dataframe
-                    # Select relevant columns for display
-                    display_columns = ['Name', 'Category', 'kcal', 'protein', 'fat', 'carbs']
+                    # The engine already returns only the display columns
                     st.dataframe(
-                        similar_foods[display_columns],
+                        similar_foods,
                         use_container_width=True,
                         hide_index=True
                     )
@@ -1,19 +1,109 @@
+import functools
+import heapq
+import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import LRUCache, TTLCache
 try:
-    from fuzzywuzzy import fuzz
+    from rapidfuzz import fuzz, utils
     FUZZY_AVAILABLE = True
 except ImportError:
     FUZZY_AVAILABLE = False
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+try:
+    import ijson
+    IJSON_AVAILABLE = True
+except ImportError:
+    IJSON_AVAILABLE = False
+
+# Exceptions raised for malformed JSON by whichever parser is in use
+# (orjson.JSONDecodeError and json.JSONDecodeError both subclass ValueError)
+_JSON_ERRORS = (ValueError, ijson.JSONError) if IJSON_AVAILABLE else (ValueError,)
 
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
 
-def search_food(query: str, use_fuzzy: bool = True) -> list[dict]:
-    # Base URL for FSVO API
-    base_url = "https://api.webapp.prod.blv.foodcase-services.com/BLV_WebApp_WS"
-    endpoint = f"{base_url}/webresources/BLV-api/foods"
+def _loads(content: bytes):
+    # orjson is several times faster than the stdlib parser on the nested payloads
+    if ORJSON_AVAILABLE:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+# Base URL for FSVO API
+_BASE_URL = "https://api.webapp.prod.blv.foodcase-services.com/BLV_WebApp_WS"
+
+# Size of the HTTP connection pool, also the number of concurrent batch requests
+_POOL_SIZE = 8
+
+# Shared HTTP session so both API calls reuse pooled keep-alive connections
+# instead of paying a new TCP + TLS handshake per request
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=_POOL_SIZE,
+    pool_maxsize=_POOL_SIZE,
+    max_retries=Retry(total=2, backoff_factor=0.2, status_forcelist=(502, 503, 504))
+))
+
+# Only JSON is ever consumed; compression (gzip/deflate, plus br when brotli
+# is installed) is already negotiated by requests' default Accept-Encoding
+_SESSION.headers.update({"Accept": "application/json"})
+
+# In-process caches of successful responses, so repeated queries and repeat
+# logs of the same food skip the network entirely. Failures are never cached.
+# TTLCache is not thread-safe, and details are prefetched from worker threads.
+_search_cache = TTLCache(maxsize=1024, ttl=300)
+_details_cache = TTLCache(maxsize=2048, ttl=86400)
+_cache_lock = threading.Lock()
+
+# ETag and parsed macros of the last successful detail response per dbid,
+# used to revalidate with If-None-Match instead of re-downloading the payload.
+# Bounded like the details cache and guarded by the same lock
+_etag_cache = LRUCache(maxsize=2048)
+
+# Required macro component names in the API response (from values array),
+# mapped to the keys returned by get_food_details.
+# The API uses component names like "Energy, kilocalories", "Protein", etc.
+_REQUIRED_COMPONENTS = {
+    "Energy, kilocalories": "kcal",
+    "Protein": "protein",
+    "Fat, total": "fat",
+    "Carbohydrates, available": "carbs"
+}
+
+# Maximum number of ranked search results returned when fuzzy ranking is on
+_TOP_K = 25
+
+# Result keys that every successful get_food_details response must contain
+_REQUIRED_KEYS = frozenset(_REQUIRED_COMPONENTS.values())
+
+
+@functools.lru_cache(maxsize=100_000)
+def _fuzzy_score(query_norm: str, name_norm: str) -> float:
+    # Typeahead queries re-score the same (query, name) pairs across keystrokes
+    # and repeated searches; both strings are already normalized by the caller
+    return fuzz.partial_ratio(query_norm, name_norm)
+
+
+def search_food(query: str, use_fuzzy: bool = True, raise_on_error: bool = False) -> list[dict]:
+    # Serve repeated queries from the cache (ranking depends on use_fuzzy)
+    cache_key = (query.lower(), use_fuzzy)
+    with _cache_lock:
+        cached_results = _search_cache.get(cache_key)
+    if cached_results is not None:
+        return list(cached_results)
+    
+    endpoint = f"{_BASE_URL}/webresources/BLV-api/foods"
     
     # Parameters for the API request
     params = {
@@ -23,13 +113,13 @@ def search_food(query: str, use_fuzzy: bool = True) -> list[dict]:
     
     try:
         # Make GET request to the API
-        response = requests.get(endpoint, params=params, timeout=10)
+        response = _SESSION.get(endpoint, params=params, timeout=10)
         
         # Raise an exception for non-200 status codes
         response.raise_for_status()
         
         # Parse JSON response - API returns a flat list of dictionaries
-        data = response.json()
+        data = _loads(response.content)
         
         # Extract food items using list comprehension
         # API structure: [{"foodName": "...", "id": ...}, ...]
@@ -41,109 +131,184 @@ def search_food(query: str, use_fuzzy: bool = True) -> list[dict]:
         
         # If we have results and fuzzy search is enabled, rank them by similarity
         if results and use_fuzzy and FUZZY_AVAILABLE:
-            # Sort results by fuzzy match score (higher is better)
-            results.sort(
-                key=lambda x: fuzz.partial_ratio(query.lower(), x["name"].lower()),
-                reverse=True
+            # Cheap string tests rank the common cases first (exact, prefix, then
+            # substring matches), so only the remaining names need fuzzy scoring.
+            # default_process lowercases and strips punctuation on both sides
+            query_norm = utils.default_process(query)
+            exact, prefix, substring, rest = [], [], [], []
+            for item in results:
+                name_norm = utils.default_process(item["name"])
+                if name_norm == query_norm:
+                    exact.append(item)
+                elif name_norm.startswith(query_norm):
+                    prefix.append(item)
+                elif query_norm in name_norm:
+                    substring.append(item)
+                else:
+                    rest.append((name_norm, item))
+            
+            # Keep only the top-scoring remaining names (higher is better) to fill
+            # the result list; nlargest is O(N log K) and keeps API order on ties.
+            # Pair scores are memoized across queries
+            ranked = exact + prefix + substring
+            top_rest = heapq.nlargest(
+                max(_TOP_K - len(ranked), 0),
+                rest,
+                key=lambda pair: _fuzzy_score(query_norm, pair[0])
             )
+            
+            results = (ranked + [item for _, item in top_rest])[:_TOP_K]
+        
+        with _cache_lock:
+            _search_cache[cache_key] = list(results)
         
         return results
         
     except requests.exceptions.RequestException as e:
         # Handle network errors, timeouts, HTTP errors, etc.
         logger.error(f"Failed to connect to FSVO API: {str(e)}")
+        if raise_on_error:
+            raise
         return []
     except ValueError as e:
         # Handle JSON parsing errors
         logger.error(f"Failed to parse API response: {str(e)}")
+        if raise_on_error:
+            raise
         return []
 
 
+def _extract_macros(values, dbid: int) -> dict | None:
+    # Walk the 'values' items and collect the required macros
+    # Each value has a 'component' object with 'name' and a 'value' field
+    found_components = {}
+    for value_item in values:
+        # Malformed items resolve to a None name and are skipped by the lookup below
+        component = value_item.get("component") if isinstance(value_item, dict) else None
+        component_name = component.get("name") if isinstance(component, dict) else None
+        
+        # Single dict lookup decides whether this component is a required macro
+        result_key = _REQUIRED_COMPONENTS.get(component_name)
+        if result_key is None:
+            continue
+        
+        # Extract the value
+        if "value" in value_item:
+            try:
+                found_components[result_key] = float(value_item["value"])
+            except (ValueError, TypeError) as e:
+                logger.error(f"Invalid value for '{component_name}' (dbid {dbid}): {value_item.get('value')}")
+                return None
+        else:
+            logger.error(f"Missing 'value' field for component '{component_name}' (dbid {dbid})")
+            return None
+        
+        # Stop scanning once all required macros are collected
+        if len(found_components) == len(_REQUIRED_KEYS):
+            break
+    
+    # Check if all required macros were found
+    missing_macros = _REQUIRED_KEYS - found_components.keys()
+    
+    if missing_macros:
+        logger.error(f"Missing required macros for dbid {dbid}: {sorted(missing_macros)}. Found: {list(found_components.keys())}")
+        return None
+    
+    return found_components
+
+
 def get_food_details(dbid: int) -> dict | None:
-    # Base URL for FSVO API
-    base_url = "https://api.webapp.prod.blv.foodcase-services.com/BLV_WebApp_WS"
-    endpoint = f"{base_url}/webresources/BLV-api/food/{dbid}"
+    # Serve foods fetched within the last day from the cache
+    with _cache_lock:
+        cached_details = _details_cache.get(dbid)
+    if cached_details is not None:
+        return dict(cached_details)
+    
+    endpoint = f"{_BASE_URL}/webresources/BLV-api/food/{dbid}"
     
     # Parameters for the API request
     params = {
         "lang": "en"
     }
     
-    # Required macro component names in the API response (from values array)
-    # The API uses component names like "Energy, kilocalories", "Protein", etc.
-    required_components = {
-        "Energy, kilocalories": "kcal",
-        "Protein": "protein",
-        "Fat, total": "fat",
-        "Carbohydrates, available": "carbs"
-    }
+    # Send a conditional request when this food was fetched before
+    headers = {}
+    with _cache_lock:
+        cached = _etag_cache.get(dbid)
+    if cached is not None:
+        headers["If-None-Match"] = cached[0]
     
     try:
-        # Make GET request to the API
-        response = requests.get(endpoint, params=params, timeout=10)
-        
-        # Raise an exception for non-200 status codes
-        response.raise_for_status()
-        
-        # Parse JSON response
-        data = response.json()
-        
-        # The API returns nutritional data in a 'values' array
-        # Each value has a 'component' object with 'name' and a 'value' field
-        if not isinstance(data, dict) or "values" not in data:
-            logger.error(f"Could not find 'values' array in API response for dbid {dbid}")
-            return None
-        
-        values_array = data["values"]
-        
-        if not isinstance(values_array, list):
-            logger.error(f"'values' is not a list in API response for dbid {dbid}")
-            return None
-        
-        # Extract macro values from the values array
-        found_components = {}
-        for value_item in values_array:
-            if not isinstance(value_item, dict) or "component" not in value_item:
-                continue
+        # Make GET request to the API, streaming the body so it can be parsed incrementally
+        with _SESSION.get(endpoint, params=params, headers=headers, timeout=10, stream=True) as response:
+            # 304 Not Modified: the previously parsed macros are still current
+            if response.status_code == 304 and cached is not None:
+                # Release the (empty) streamed body so the keep-alive connection
+                # returns to the pool instead of being closed
+                response.raw.drain_conn()
+                with _cache_lock:
+                    _details_cache[dbid] = dict(cached[1])
+                return dict(cached[1])
+            
+            # Raise an exception for non-200 status codes
+            response.raise_for_status()
+            
+            if IJSON_AVAILABLE:
+                # Parse the 'values' items straight off the socket and stop as soon as
+                # the four macros are seen, without building the full payload tree
+                response.raw.decode_content = True
+                values = ijson.items(response.raw, "values.item", use_float=True)
+                found_components = _extract_macros(values, dbid)
                 
-            component = value_item["component"]
-            if not isinstance(component, dict) or "name" not in component:
-                continue
+                # Discard the unread tail so the keep-alive connection returns to the pool
+                response.raw.drain_conn()
+            else:
+                # Parse JSON response
+                data = _loads(response.content)
                 
-            component_name = component["name"]
-            
-            # Check if this component matches any required macro
-            if component_name in required_components:
-                result_key = required_components[component_name]
+                # The API returns nutritional data in a 'values' array
+                if not isinstance(data, dict) or "values" not in data:
+                    logger.error(f"Could not find 'values' array in API response for dbid {dbid}")
+                    return None
                 
-                # Extract the value
-                if "value" in value_item:
-                    try:
-                        found_components[result_key] = float(value_item["value"])
-                    except (ValueError, TypeError) as e:
-                        logger.error(f"Invalid value for '{component_name}' (dbid {dbid}): {value_item.get('value')}")
-                        return None
-                else:
-                    logger.error(f"Missing 'value' field for component '{component_name}' (dbid {dbid})")
+                values_array = data["values"]
+                
+                if not isinstance(values_array, list):
+                    logger.error(f"'values' is not a list in API response for dbid {dbid}")
                     return None
-        
-        # Check if all required macros were found
-        missing_macros = [result_key for result_key in required_components.values() 
-                         if result_key not in found_components]
-        
-        if missing_macros:
-            logger.error(f"Missing required macros for dbid {dbid}: {missing_macros}. Found: {list(found_components.keys())}")
-            return None
+                
+                found_components = _extract_macros(values_array, dbid)
+            
+            if found_components is None:
+                return None
+            
+            # Remember the validator so the next request for this food can be conditional
+            etag = response.headers.get("ETag")
+            with _cache_lock:
+                if etag:
+                    _etag_cache[dbid] = (etag, dict(found_components))
+                _details_cache[dbid] = dict(found_components)
         
         # All required macros were found and extracted successfully
         return found_components
             
-    except requests.exceptions.RequestException as e:
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
         # Handle network errors, timeouts, HTTP errors, etc.
+        # (urllib3 errors surface directly while reading the raw stream)
         logger.error(f"Failed to connect to FSVO API for dbid {dbid}: {str(e)}")
         return None
-    except ValueError as e:
+    except _JSON_ERRORS as e:
         # Handle JSON parsing errors
         logger.error(f"Failed to parse API response for dbid {dbid}: {str(e)}")
         return None
 
+
+def get_food_details_batch(dbids: list[int]) -> dict[int, dict | None]:
+    # Fetch several foods concurrently over the shared connection pool, so the
+    # total latency is about one round-trip instead of one per food
+    unique_dbids = list(dict.fromkeys(dbids))
+    if not unique_dbids:
+        return {}
+    
+    with ThreadPoolExecutor(max_workers=min(len(unique_dbids), _POOL_SIZE)) as executor:
+        return dict(zip(unique_dbids, executor.map(get_food_details, unique_dbids)))
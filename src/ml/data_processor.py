@@ -1,6 +1,12 @@
 import logging
+import os
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
+from pandas.api.types import is_float_dtype
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.compose import ColumnTransformer
@@ -9,23 +15,20 @@ from typing import Tuple
 # Configure logger for this module
 logger = logging.getLogger(__name__)
 
+# Version of the cleaning steps (2-5), part of the processed-data cache file name;
+# bump it whenever _clean_df or _compute_pct change their output
+_CLEANING_VERSION = 1
 
-def load_and_preprocess_data(filepath: str) -> Tuple[pd.DataFrame, Pipeline]:
-    # Step 1: Load the Excel file into a pandas DataFrame
-    # The Excel file has:
-    # - Row 0: Title row (skip)
-    # - Row 1: Blank row (skip)
-    # - Row 2: Header row with column names (use as header)
-    # - Row 3+: Data rows
-    
-    # Convert filepath to Path object for easier handling
-    filepath = Path(filepath)
-    
-    logger.info(f"Loading data from {filepath}...")
-    
-    if not filepath.exists():
-        raise FileNotFoundError(f"Data file not found: {filepath}")
-    
+
+def _compute_pct(m: np.ndarray) -> np.ndarray:
+    # Share of each macro in the row's total grams for an (N x 3) array m of any
+    # numeric dtype, returned as a new float64 array (m is left untouched); the
+    # guarded divide (no division by zero) leaves rows without a positive total at 0
+    total_macros_g = m.sum(axis=1, keepdims=True)
+    return np.divide(m, total_macros_g, out=np.zeros(m.shape, dtype=np.float64), where=total_macros_g > 0)
+
+
+def _clean_df(df: pd.DataFrame, filepath: Path) -> pd.DataFrame:
     # Step 2: Define required columns
     required_columns = [
         'Name',
@@ -36,9 +39,6 @@ def load_and_preprocess_data(filepath: str) -> Tuple[pd.DataFrame, Pipeline]:
         'Carbohydrates, available (g)'
     ]
     
-    # Load the Excel file with header row 2 (standardized structure)
-    df = pd.read_excel(filepath, header=2)
-    
     # Check if all required columns are present
     missing = [col for col in required_columns if col not in df.columns]
     if missing:
@@ -68,25 +68,29 @@ def load_and_preprocess_data(filepath: str) -> Tuple[pd.DataFrame, Pipeline]:
     if dropped_rows > 0:
         logger.warning(f"Dropped {dropped_rows} rows with missing macro values")
     
-    # Convert macro columns to float to ensure numeric type
-    for col in macro_columns:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
+    # Convert macro columns to float to ensure numeric type, in one call over the
+    # 4-column block; skipped when openpyxl already produced float columns
+    if not all(is_float_dtype(df[col]) for col in macro_columns):
+        df[macro_columns] = df[macro_columns].apply(pd.to_numeric, errors='coerce')
     
     # Drop any rows that couldn't be converted to numeric
     df = df.dropna(subset=macro_columns)
     
     # Step 5: Feature Engineering - Calculate percentage distributions
-    # Calculate total grams of protein + fat + carbs
-    df['total_macros_g'] = df['protein'] + df['fat'] + df['carbs']
-    
-    # Calculate percentages (handle division by zero)
-    df['protein_pct'] = (df['protein'] / df['total_macros_g']).fillna(0)
-    df['fat_pct'] = (df['fat'] / df['total_macros_g']).fillna(0)
-    df['carbs_pct'] = (df['carbs'] / df['total_macros_g']).fillna(0)
-    
-    # Drop the temporary column
-    df = df.drop(columns=['total_macros_g'])
+    # Work on one contiguous (N x 3) array of protein, fat, carbs grams
+    macros = df[['protein', 'fat', 'carbs']].to_numpy(dtype=np.float64)
+    df[['protein_pct', 'fat_pct', 'carbs_pct']] = _compute_pct(macros)
     
+    return df
+
+
+def _read_and_clean_excel(filepath: Path) -> pd.DataFrame:
+    # Load the Excel file with header row 2 (standardized structure)
+    df = pd.read_excel(filepath, header=2, engine='openpyxl')
+    return _clean_df(df, filepath)
+
+
+def _preprocess_df(df: pd.DataFrame) -> Tuple[pd.DataFrame, Pipeline, np.ndarray]:
     # Step 6: Create preprocessing pipeline
     # IMPORTANT: We intentionally EXCLUDE 'kcal' from the ML feature space.
     # Rationale: 'kcal' in the UI often represents remaining daily calories,
@@ -114,10 +118,91 @@ def load_and_preprocess_data(filepath: str) -> Tuple[pd.DataFrame, Pipeline]:
     # Prepare the feature matrix for fitting
     X = df[feature_columns]
     
-    # Fit and transform the pipeline
-    pipeline.fit(X)
+    # Fit and transform the pipeline in one pass
+    X_features = pipeline.fit_transform(X)
     logger.info(f"Pipeline fitted successfully on {len(df)} samples with features: {feature_columns}")
     
-    # Return the cleaned DataFrame and the fitted pipeline
-    return df, pipeline
+    # Return the cleaned DataFrame, the fitted pipeline and the scaled feature matrix
+    # (row i of the matrix corresponds to row i of the DataFrame)
+    return df, pipeline, X_features
+
+
+def _read_processed_cache(parquet_path: Path, source_stat: os.stat_result) -> pd.DataFrame | None:
+    # Return the cleaned data cached for this exact workbook (same mtime and size),
+    # or None when the cache is missing, stale or unreadable
+    if not parquet_path.exists():
+        return None
+    try:
+        table = pq.read_table(parquet_path)
+        metadata = table.schema.metadata or {}
+        if (metadata.get(b'source_mtime_ns') != str(source_stat.st_mtime_ns).encode()
+                or metadata.get(b'source_size') != str(source_stat.st_size).encode()):
+            return None
+        return table.to_pandas()
+    except Exception as e:
+        logger.warning(f"Could not read Parquet cache {parquet_path}: {str(e)}")
+        return None
+
 
+def _write_processed_cache(df: pd.DataFrame, parquet_path: Path, source_stat: os.stat_result) -> None:
+    # Record the workbook's mtime and size with the data, and write to a temporary
+    # file in the same directory first so a partial write never replaces the cache
+    table = pa.Table.from_pandas(df)
+    table = table.replace_schema_metadata({
+        **(table.schema.metadata or {}),
+        b'source_mtime_ns': str(source_stat.st_mtime_ns).encode(),
+        b'source_size': str(source_stat.st_size).encode(),
+    })
+    fd, tmp_path = tempfile.mkstemp(dir=parquet_path.parent, prefix=f".{parquet_path.name}.", suffix='.tmp')
+    os.close(fd)
+    try:
+        pq.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, parquet_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def load_and_preprocess_data(filepath: str) -> Tuple[pd.DataFrame, Pipeline, np.ndarray]:
+    # Step 1: Load the Excel file into a pandas DataFrame
+    # The Excel file has:
+    # - Row 0: Title row (skip)
+    # - Row 1: Blank row (skip)
+    # - Row 2: Header row with column names (use as header)
+    # - Row 3+: Data rows
+    
+    # Convert filepath to Path object for easier handling
+    filepath = Path(filepath)
+    
+    logger.info(f"Loading data from {filepath}...")
+    
+    if not filepath.exists():
+        raise FileNotFoundError(f"Data file not found: {filepath}")
+    
+    # A Parquet source holds the same columns as the workbook's header row and is
+    # cleaned directly, without the openpyxl parse or the processed-data cache
+    if filepath.suffix == '.parquet':
+        return _preprocess_df(_clean_df(pd.read_parquet(filepath), filepath))
+    
+    # Reuse the cleaned Parquet copy when it was written from this exact workbook (same
+    # mtime and size) by the current cleaning version; it skips both the slow openpyxl
+    # parse and the cleaning steps below
+    parquet_path = filepath.with_name(f"{filepath.stem}.processed.v{_CLEANING_VERSION}.parquet")
+    source_stat = filepath.stat()
+    
+    df = _read_processed_cache(parquet_path, source_stat)
+    if df is not None:
+        logger.info(f"Loaded cached data from {parquet_path}")
+    else:
+        # Steps 2-5: Read, validate and clean the workbook
+        df = _read_and_clean_excel(filepath)
+        
+        # Write the Parquet copy for the next start (best effort, the xlsx stays the source of truth)
+        try:
+            _write_processed_cache(df, parquet_path, source_stat)
+            logger.info(f"Cached data to {parquet_path}")
+        except Exception as e:
+            logger.warning(f"Could not write Parquet cache {parquet_path}: {str(e)}")
+    
+    # Steps 6-7: Build and fit the preprocessing pipeline
+    return _preprocess_df(df)
@@ -1,55 +1,244 @@
+import functools
+import hashlib
+import os
+import re
+from collections import defaultdict
+from pathlib import Path
+import joblib
 import pandas as pd
 import numpy as np
+import sklearn
 from sklearn.cluster import KMeans
 from sklearn.neighbors import NearestNeighbors
 from src.ml.data_processor import load_and_preprocess_data
 
+# Version of the saved-model format; bump it when the fitted models or the
+# k-NN graph change in a way the other validity checks can't detect
+_CACHE_VERSION = 1
+
+# Neighbors precomputed per food at init; covers n_recommendations up to 10
+_KNN_GRAPH_SIZE = 32
+
+# Foods with less than this many grams of total macros per 100g (mostly water/fiber)
+# are never goal-aligned recommendations
+_MIN_MACRO_DENSITY = 10
+
+# Precision of the target ratios used as the cluster-prediction cache key
+_RATIO_DECIMALS = 4
+
+
+def _score_cluster(cluster_features: np.ndarray, target_features: np.ndarray,
+                   pfc: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """
+    Score the foods of a cluster against a target; lower is better.
+    
+    Combines the distance to the target macro ratios (lower is better) with
+    the weighted absolute macro contribution (higher is better), each
+    normalized by its maximum, weighting contribution more heavily.
+    """
+    diff = cluster_features - target_features
+    ratio_distances = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+    contribution_scores = pfc @ weights
+    
+    max_distance = ratio_distances.max() if len(ratio_distances) > 0 else 1
+    max_contribution = contribution_scores.max() if len(contribution_scores) > 0 else 1
+    
+    normalized_distances = ratio_distances / max_distance if max_distance > 0 else ratio_distances
+    normalized_contributions = contribution_scores / max_contribution if max_contribution > 0 else np.zeros_like(contribution_scores)
+    
+    return 0.4 * normalized_distances + 0.6 * (1 - normalized_contributions)
+
 
 class RecommendationEngine:
     
-    def __init__(self, data_filepath: str):
+    def __init__(self, data_filepath: str, *, n_clusters: int = 8, kmeans_kwargs: dict = None):
         # Step 1: Load and preprocess the data. The processor will create a pipeline
         # that is fitted on ['protein_pct', 'fat_pct', 'carbs_pct'].
         print(f"Initializing RecommendationEngine with data from {data_filepath}...")
-        self.data, self.preprocessor = load_and_preprocess_data(data_filepath)
+        
+        # Step 2: The processor also returns the scaled feature matrix from fit_transform,
+        # so the features are not transformed a second time here.
+        self.data, self.preprocessor, self.X_features = load_and_preprocess_data(data_filepath)
         
         # Reset index to ensure positional alignment with numpy arrays
         # This ensures that self.X_features[i] corresponds to self.data.iloc[i]
         self.data = self.data.reset_index(drop=True)
         
-        # Step 2: Prepare feature matrix for transformation.
-        # This MUST align with the features the preprocessor was trained on.
-        feature_columns = ['protein_pct', 'fat_pct', 'carbs_pct']
-        X_raw = self.data[feature_columns]
-        
-        # Transform the features using the fitted preprocessor pipeline.
-        self.X_features = self.preprocessor.transform(X_raw)
+        # Lowercased names, computed once for the case-insensitive lookups
+        self._name_lower = self.data['Name'].str.lower()
+        # ...and as a fixed-width unicode array for C-level substring search
+        # (missing names become '' so they only match an empty query)
+        self._name_lower_np = self._name_lower.fillna('').to_numpy(dtype=str)
+        
+        # Positional index of every lowercased food name for O(1) exact lookups
+        # (the first occurrence wins for duplicate names)
+        self._name_to_idx = {}
+        for pos_idx, name in enumerate(self._name_lower.to_numpy()):
+            if isinstance(name, str):
+                self._name_to_idx.setdefault(name, pos_idx)
+        
+        # Inverted index of name tokens -> positions, used to suggest similar names
+        # without scanning every name
+        self._token_index = defaultdict(list)
+        for pos_idx, name in enumerate(self._name_lower.to_numpy()):
+            if isinstance(name, str):
+                for token in set(re.findall(r'\w+', name)):
+                    self._token_index[token].append(pos_idx)
+        
+        # Raw NumPy views of the hot columns, indexed directly instead of through
+        # per-row .iloc lookups (macros are in protein, fat, carbs order)
+        self._names = self.data['Name'].to_numpy()
+        self._categories = self.data['Category'].to_numpy()
+        self._macros = self.data[['protein', 'fat', 'carbs']].to_numpy()
+        self._pcts = self.data[['protein_pct', 'fat_pct', 'carbs_pct']].to_numpy()
+        
+        # Store the features as a C-contiguous float32 array: the macro ratios don't need
+        # double precision, half-size rows halve the memory scanned by the distance
+        # kernels, and KMeans/NearestNeighbors are fitted on (and keep) this dtype
+        self.X_features = np.ascontiguousarray(self.X_features, dtype=np.float32)
         
         print(f"Feature matrix shape: {self.X_features.shape}")
         
-        # Step 3: Train K-Means clustering model
-        print("Training K-Means clustering model (8 clusters)...")
-        self.kmeans_model = KMeans(
-            n_clusters=8,
-            random_state=42,
-            n_init='auto'
-        )
-        self.kmeans_model.fit(self.X_features)
+        # K-Means settings: the defaults below, overridable per engine (e.g. a single
+        # init and few iterations for tiny datasets)
+        self._kmeans_params = {
+            'n_clusters': n_clusters,
+            'random_state': 42,
+            'n_init': 'auto',
+            **(kmeans_kwargs or {})
+        }
+        
+        # Step 3: Reuse the models fitted on this exact data file when a saved copy exists,
+        # otherwise train them and save them for the next start
+        models_path = Path(data_filepath).with_name(f"{Path(data_filepath).stem}.models.joblib")
+        data_mtime = os.path.getmtime(data_filepath)
+        # Fingerprint of the exact feature matrix, so any change in cleaning or
+        # preprocessing invalidates the saved models
+        self._features_hash = hashlib.blake2b(self.X_features.tobytes(), digest_size=16).hexdigest()
+        saved_models = self._load_models(models_path, data_mtime)
+        
+        if saved_models is not None:
+            print(f"Loaded fitted models from {models_path}")
+            self.kmeans_model = saved_models['kmeans_model']
+            self.nn_model = saved_models['nn_model']
+            self._all_dists = saved_models['all_dists']
+            self._all_idx = saved_models['all_idx']
+        else:
+            self._fit_models()
+            try:
+                joblib.dump({
+                    'cache_version': _CACHE_VERSION,
+                    'sklearn_version': sklearn.__version__,
+                    'features_hash': self._features_hash,
+                    'data_mtime': data_mtime,
+                    'n_samples': len(self.X_features),
+                    'kmeans_params': self._kmeans_params,
+                    'kmeans_model': self.kmeans_model,
+                    'nn_model': self.nn_model,
+                    'all_dists': self._all_dists,
+                    'all_idx': self._all_idx,
+                }, models_path, compress=0)
+                print(f"Saved fitted models to {models_path}")
+            except Exception as e:
+                print(f"DEBUG: Could not save fitted models to {models_path}: {str(e)}")
+        
         self.data['cluster'] = self.kmeans_model.labels_
         
-        print(f"K-Means training complete. Cluster distribution:")
+        # Positional indices of each cluster's foods; clusters are fixed after training,
+        # so goal queries gather their cluster's rows instead of masking the whole table
+        self._cluster_members = {
+            c: np.flatnonzero(self.kmeans_model.labels_ == c)
+            for c in range(self.kmeans_model.n_clusters)
+        }
+        
+        # Density-filtered members of each cluster and their features as contiguous
+        # float32 blocks; both are static, so goal queries skip the per-call filter and
+        # score a cache-friendly block instead of gathering rows from self.X_features
+        dense = self._macros.sum(axis=1) >= _MIN_MACRO_DENSITY
+        self._cluster_dense = {
+            c: members[dense[members]]
+            for c, members in self._cluster_members.items()
+        }
+        self._cluster_X = {
+            c: np.ascontiguousarray(self.X_features[members])
+            for c, members in self._cluster_dense.items()
+        }
+        
+        print(f"Cluster distribution:")
         print(self.data['cluster'].value_counts().sort_index())
         
-        # Step 4: Train Nearest Neighbors model
+        # Scaler statistics and centroids let get_goal_aligned_foods scale its one-row
+        # target and pick a cluster with plain NumPy instead of pandas/sklearn dispatch
+        scaler = self.preprocessor.named_steps['preprocessor'].named_transformers_['scaler']
+        self._feature_mean = scaler.mean_.astype(np.float32)
+        self._feature_scale = scaler.scale_.astype(np.float32)
+        self._centroids = self.kmeans_model.cluster_centers_.astype(np.float32, copy=False)
+        
+        # Per-instance LRU cache of cluster predictions (lru_cache on the method itself
+        # would share one cache across engines and keep them alive)
+        self._predict_cluster = functools.lru_cache(maxsize=1024)(self._nearest_cluster)
+        
+        print(f"RecommendationEngine initialized successfully with {len(self.data)} foods.")
+    
+    def _load_models(self, models_path: Path, data_mtime: float):
+        # Saved models are only valid for the cache format, sklearn version, feature
+        # matrix, data file (and row count) and K-Means settings they were fitted with
+        if not models_path.exists():
+            return None
+        try:
+            saved_models = joblib.load(models_path)
+        except Exception as e:
+            print(f"DEBUG: Could not load fitted models from {models_path}: {str(e)}")
+            return None
+        if (not isinstance(saved_models, dict)
+                or saved_models.get('cache_version') != _CACHE_VERSION
+                or saved_models.get('sklearn_version') != sklearn.__version__
+                or saved_models.get('features_hash') != self._features_hash
+                or saved_models.get('data_mtime') != data_mtime
+                or saved_models.get('n_samples') != len(self.X_features)
+                or saved_models.get('kmeans_params') != self._kmeans_params):
+            return None
+        return saved_models
+    
+    def _fit_models(self):
+        # Step 3a: Train K-Means clustering model
+        print(f"Training K-Means clustering model ({self._kmeans_params['n_clusters']} clusters)...")
+        self.kmeans_model = KMeans(**self._kmeans_params)
+        self.kmeans_model.fit(self.X_features)
+        print("K-Means training complete.")
+        
+        # Step 3b: Train Nearest Neighbors model
         print("Training Nearest Neighbors model (6 neighbors)...")
+        # A KD-tree answers queries in O(log N) on this low-dimensional (3 features) space
         self.nn_model = NearestNeighbors(
             n_neighbors=6,
+            algorithm='kd_tree',
+            leaf_size=32,
             metric='euclidean'
         )
         self.nn_model.fit(self.X_features)
         
+        # Precompute the k-NN graph once: the data is static, so similar-food queries
+        # become a row lookup instead of a tree traversal per call
+        n_graph = min(_KNN_GRAPH_SIZE, len(self.data))
+        all_dists, all_idx = self.nn_model.kneighbors(self.X_features, n_neighbors=n_graph)
+        self._all_dists = all_dists.astype(np.float32)
+        self._all_idx = all_idx.astype(np.int32)
+        
         print("Nearest Neighbors training complete.")
-        print(f"RecommendationEngine initialized successfully with {len(self.data)} foods.")
+    
+    def _scale_ratios(self, protein_pct: float, fat_pct: float, carbs_pct: float) -> np.ndarray:
+        # One-row feature vector standardized with the fitted scaler statistics;
+        # float32 matches the dtype the models were fitted on
+        return (
+            np.array([[protein_pct, fat_pct, carbs_pct]], dtype=np.float32)
+            - self._feature_mean
+        ) / self._feature_scale
+    
+    def _nearest_cluster(self, protein_pct: float, fat_pct: float, carbs_pct: float) -> int:
+        # Nearest centroid, as KMeans.predict
+        target_features = self._scale_ratios(protein_pct, fat_pct, carbs_pct)
+        return int(np.argmin(((self._centroids - target_features) ** 2).sum(axis=1)))
     
     def get_similar_foods(self, food_name: str, n_recommendations: int = 5) -> pd.DataFrame:
         """
@@ -60,73 +249,72 @@ class RecommendationEngine:
             n_recommendations: Number of recommendations to return
         """
         # Step 1: Find the positional index of the food_name in self.data
-        # Try exact match first (case-insensitive)
-        food_mask = self.data['Name'].str.lower() == food_name.lower()
+        # Try exact match first (case-insensitive), a single dict lookup
+        food_pos_idx = self._name_to_idx.get(food_name.lower())
         
-        # If no exact match, try partial match (contains)
-        if not food_mask.any():
-            food_mask = self.data['Name'].str.lower().str.contains(food_name.lower(), na=False, regex=False)
+        if food_pos_idx is None:
+            # If no exact match, try partial match (contains)
+            food_mask = np.char.find(self._name_lower_np, food_name.lower()) >= 0
             print(f"DEBUG: No exact match for '{food_name}', trying partial match...")
+            
+            if not food_mask.any():
+                print(f"DEBUG: Food '{food_name}' not found in database.")
+                print(f"DEBUG: Searching for similar names...")
+                # Show some foods sharing the first word of the query (token index lookup)
+                query_tokens = re.findall(r'\w+', food_name.lower())
+                similar_pos = self._token_index.get(query_tokens[0], [])[:5] if query_tokens else []
+                if similar_pos:
+                    print(f"DEBUG: Similar names found: {list(self._names[similar_pos])}")
+                return pd.DataFrame()
+            
+            # Get the first matching positional index (since index was reset in __init__)
+            food_pos_idx = int(np.argmax(food_mask))
         
-        if not food_mask.any():
-            print(f"DEBUG: Food '{food_name}' not found in database.")
-            print(f"DEBUG: Searching for similar names...")
-            # Try fuzzy matching - show some foods with similar names
-            similar_names = self.data[self.data['Name'].str.lower().str.contains(food_name.lower().split()[0] if food_name else '', na=False, regex=False)]['Name'].head(5)
-            if len(similar_names) > 0:
-                print(f"DEBUG: Similar names found: {list(similar_names)}")
-            return pd.DataFrame()
-
-        # Get the first matching positional index (since index was reset in __init__)
-        food_pos_idx = food_mask[food_mask].index[0]
-        food_category = self.data.iloc[food_pos_idx]['Category']
-        food_macros = self.data.iloc[food_pos_idx][['protein', 'fat', 'carbs']]
-        matched_name = self.data.iloc[food_pos_idx]['Name']
+        food_category = self._categories[food_pos_idx]
+        food_protein, food_fat, food_carbs = self._macros[food_pos_idx]
+        matched_name = self._names[food_pos_idx]
         
         print(f"DEBUG: Finding similar foods for '{food_name}' -> matched '{matched_name}' (Category: {food_category}, Position: {food_pos_idx})")
-        print(f"DEBUG: Food macros - P: {food_macros['protein']}g, F: {food_macros['fat']}g, C: {food_macros['carbs']}g")
+        print(f"DEBUG: Food macros - P: {food_protein}g, F: {food_fat}g, C: {food_carbs}g")
         
-        # Step 2: Get the feature vector for this food (which is based on ratios only)
-        food_features = self.X_features[food_pos_idx:food_pos_idx+1]
-        
-        # Step 3: Use kneighbors to find neighbors - search more neighbors to get better same-category matches
-        # Search for more neighbors than needed to ensure we have enough same-category options
+        # Step 2: Search more neighbors than needed to ensure we have enough same-category options
         search_neighbors = min(n_recommendations * 3 + 1, len(self.data))
-        distances, neighbor_indices = self.nn_model.kneighbors(food_features, n_neighbors=search_neighbors)
-        
-        neighbor_indices = neighbor_indices[0]
-        neighbor_distances = distances[0]
-        
-        # Step 4: Create list of neighbors with additional info
-        neighbors_with_info = []
-        for pos_idx, dist in zip(neighbor_indices, neighbor_distances):
-            if pos_idx != food_pos_idx:
-                same_category = self.data.iloc[pos_idx]['Category'] == food_category
-                neighbor_macros = self.data.iloc[pos_idx][['protein', 'fat', 'carbs']]
-                # Calculate macro similarity (absolute difference in macro percentages)
-                neighbor_features = self.X_features[pos_idx:pos_idx+1]
-                macro_diff = np.linalg.norm(food_features - neighbor_features)
-                
-                neighbors_with_info.append((pos_idx, dist, same_category, macro_diff))
-        
-        if not neighbors_with_info:
+        
+        # Step 3: Read the neighbors from the precomputed k-NN graph; only larger requests
+        # query the model with this food's feature vector (which is based on ratios only)
+        if search_neighbors <= self._all_idx.shape[1]:
+            neighbor_indices = self._all_idx[food_pos_idx, :search_neighbors]
+            neighbor_distances = self._all_dists[food_pos_idx, :search_neighbors]
+        else:
+            food_features = self.X_features[food_pos_idx:food_pos_idx+1]
+            distances, neighbor_indices = self.nn_model.kneighbors(food_features, n_neighbors=search_neighbors)
+            neighbor_indices = neighbor_indices[0]
+            neighbor_distances = distances[0]
+        
+        # Step 4: Drop the food itself and flag same-category neighbors in one pass.
+        # The euclidean kneighbors distance already is the macro-ratio difference.
+        keep = neighbor_indices != food_pos_idx
+        neighbor_indices = neighbor_indices[keep]
+        neighbor_distances = neighbor_distances[keep]
+        
+        if len(neighbor_indices) == 0:
             print(f"DEBUG: No other similar foods found for '{food_name}'.")
             return pd.DataFrame()
         
+        same_category = self._categories[neighbor_indices] == food_category
+        
         # Step 5: Rank neighbors with strong priority for same category
         # Sort by: (not same_category, macro_diff) - same category foods first, then by macro similarity
         # This ensures oils find other oils, lean meats find other lean meats, etc.
-        ranked = sorted(neighbors_with_info, key=lambda x: (not x[2], x[3]))
+        ranked = np.lexsort((neighbor_distances, ~same_category))
         
         # Take top recommendations
-        top_neighbors = ranked[:n_recommendations]
-        final_pos_indices = [pos_idx for pos_idx, _, _, _ in top_neighbors]
-        
-        # Step 6: Return DataFrame with recommended foods
-        recommended_foods = self.data.iloc[final_pos_indices].copy()
+        final_pos_indices = neighbor_indices[ranked[:n_recommendations]]
         
+        # Step 6: Return DataFrame with recommended foods, sliced to the display columns
+        # (the gather already returns a new frame, so no defensive copy is needed)
         output_columns = ['Name', 'Category', 'kcal', 'protein', 'fat', 'carbs']
-        return recommended_foods[output_columns]
+        return self.data.iloc[final_pos_indices][output_columns].reset_index(drop=True)
 
     def get_goal_aligned_foods(self, remaining_macros: dict, user_goals: dict = None, n_recommendations: int = 5) -> pd.DataFrame:
         """
@@ -163,109 +351,116 @@ class RecommendationEngine:
             }
             print(f"DEBUG: Goal completion - P: {goal_completion['protein']:.1%}, F: {goal_completion['fat']:.1%}, C: {goal_completion['carbs']:.1%}")
         
-        # Step 3: Create a target vector matching the preprocessor's expected input.
-        target_df = pd.DataFrame([{
-            'protein_pct': target_protein_pct,
-            'fat_pct': target_fat_pct,
-            'carbs_pct': target_carbs_pct
-        }])
-        
-        # Transform the target vector into the scaled feature space
-        target_features = self.preprocessor.transform(target_df)
+        # Step 3: Create a target vector in the preprocessor's feature order
+        # (protein_pct, fat_pct, carbs_pct) and standardize it like the StandardScaler does
+        target_features = self._scale_ratios(target_protein_pct, target_fat_pct, target_carbs_pct)
         
-        # Step 4: Predict the best-matching cluster
-        predicted_cluster = self.kmeans_model.predict(target_features)[0]
+        # Step 4: Predict the best-matching cluster. Repeated goal queries hit the cache,
+        # keyed on ratios rounded so near-identical targets share an entry
+        predicted_cluster = self._predict_cluster(
+            round(target_protein_pct, _RATIO_DECIMALS),
+            round(target_fat_pct, _RATIO_DECIMALS),
+            round(target_carbs_pct, _RATIO_DECIMALS)
+        )
         print(f"DEBUG: Predicted cluster: {predicted_cluster}")
         
-        # Step 5: Get all foods from that cluster
-        cluster_mask = self.data['cluster'] == predicted_cluster
-        cluster_foods = self.data[cluster_mask].copy()
+        # Step 5: Get the positions of all foods from that cluster
+        cluster_pos = self._cluster_members[predicted_cluster]
         
-        if cluster_foods.empty:
+        if len(cluster_pos) == 0:
             print(f"DEBUG: No foods found in cluster {predicted_cluster}.")
             return pd.DataFrame()
         
-        print(f"DEBUG: Found {len(cluster_foods)} foods in cluster {predicted_cluster}")
+        print(f"DEBUG: Found {len(cluster_pos)} foods in cluster {predicted_cluster}")
         
         # Step 6: Filter out foods with very low macro density (mostly water/fiber)
-        # Calculate total macros per 100g for each food
-        cluster_foods['total_macros'] = cluster_foods['protein'] + cluster_foods['fat'] + cluster_foods['carbs']
-        MIN_MACRO_DENSITY = 10  # Filter out foods with less than 10g total macros per 100g
-        cluster_foods = cluster_foods[cluster_foods['total_macros'] >= MIN_MACRO_DENSITY].copy()
-        print(f"DEBUG: After filtering low-density foods (<{MIN_MACRO_DENSITY}g total macros): {len(cluster_foods)} foods remaining")
+        # The filter is static, so each cluster's dense members were selected at init
+        cluster_pos = self._cluster_dense[predicted_cluster]
+        print(f"DEBUG: After filtering low-density foods (<{_MIN_MACRO_DENSITY}g total macros): {len(cluster_pos)} foods remaining")
         
-        if cluster_foods.empty:
+        if len(cluster_pos) == 0:
             print("DEBUG: No foods with sufficient macro density found.")
             return pd.DataFrame()
         
         # Step 7: Smart Filtering - Remove foods high in macros that are already mostly met
-        def is_suitable(food):
-            # Filter out foods high in macros that are already mostly met (e.g., >50% goal completion)
-            if user_goals:
-                if goal_completion['fat'] > 0.5 and food['fat_pct'] > 0.60:  # Fat goal >50% met, food is >60% fat
-                    return False
-                if goal_completion['protein'] > 0.5 and food['protein_pct'] > 0.60:  # Protein goal >50% met
-                    return False
-                if goal_completion['carbs'] > 0.5 and food['carbs_pct'] > 0.60:  # Carbs goal >50% met
-                    return False
-            
-            # Filter out foods high in macros that are NOT needed (remaining < 10g)
-            if remaining_macros['fat'] < 10 and food['fat_pct'] > 0.50:
-                return False
-            if remaining_macros['protein'] < 10 and food['protein_pct'] > 0.50:
-                return False
-            if remaining_macros['carbs'] < 10 and food['carbs_pct'] > 0.50:
-                return False
-            
-            return True
+        # Built as one boolean mask; the goal/remaining conditions are scalars, so each
+        # rule only touches the column arrays when it applies
+        protein_pct, fat_pct, carbs_pct = self._pcts[cluster_pos].T
+        suitable_mask = np.ones(len(cluster_pos), dtype=bool)
+        
+        # Filter out foods high in macros that are already mostly met (e.g., >50% goal completion)
+        if user_goals:
+            if goal_completion['fat'] > 0.5:  # Fat goal >50% met, food is >60% fat
+                suitable_mask &= fat_pct <= 0.60
+            if goal_completion['protein'] > 0.5:  # Protein goal >50% met
+                suitable_mask &= protein_pct <= 0.60
+            if goal_completion['carbs'] > 0.5:  # Carbs goal >50% met
+                suitable_mask &= carbs_pct <= 0.60
+        
+        # Filter out foods high in macros that are NOT needed (remaining < 10g)
+        if remaining_macros['fat'] < 10:
+            suitable_mask &= fat_pct <= 0.50
+        if remaining_macros['protein'] < 10:
+            suitable_mask &= protein_pct <= 0.50
+        if remaining_macros['carbs'] < 10:
+            suitable_mask &= carbs_pct <= 0.50
 
-        suitable_indices = cluster_foods[cluster_foods.apply(is_suitable, axis=1)].index
-        print(f"DEBUG: After filtering unsuitable foods: {len(suitable_indices)} foods remaining")
+        suitable_idx = np.flatnonzero(suitable_mask)
+        print(f"DEBUG: After filtering unsuitable foods: {len(suitable_idx)} foods remaining")
         
         # Step 8: Score foods based on:
         # - Distance to target macro ratios (lower is better)
         # - Absolute macro contribution (higher is better for needed macros)
-        cluster_pos_indices = cluster_foods.index.values
-        cluster_features = self.X_features[cluster_pos_indices]
-        ratio_distances = np.linalg.norm(cluster_features - target_features, axis=1)
-        
-        # Calculate contribution score: how much this food helps meet absolute goals
-        contribution_scores = []
-        for idx in cluster_foods.index:
-            food = cluster_foods.loc[idx]
-            # Prioritize foods that provide substantial amounts of needed macros
-            contribution = 0
-            if remaining_macros['protein'] > 0:
-                contribution += food['protein'] * (remaining_macros['protein'] / total_pfc_grams)
-            if remaining_macros['fat'] > 0:
-                contribution += food['fat'] * (remaining_macros['fat'] / total_pfc_grams)
-            if remaining_macros['carbs'] > 0:
-                contribution += food['carbs'] * (remaining_macros['carbs'] / total_pfc_grams)
-            contribution_scores.append(contribution)
-        
-        # Normalize scores (ratio distance: lower is better, contribution: higher is better)
-        # Combine: lower ratio distance + higher contribution = better score
-        max_contribution = max(contribution_scores) if contribution_scores else 1
-        max_distance = max(ratio_distances) if len(ratio_distances) > 0 else 1
-        
-        # Normalize and combine (weight contribution more heavily)
-        normalized_distances = ratio_distances / max_distance if max_distance > 0 else ratio_distances
-        normalized_contributions = [c / max_contribution if max_contribution > 0 else 0 for c in contribution_scores]
-        
-        # Combined score: lower is better (inverse of contribution)
-        combined_scores = 0.4 * normalized_distances + 0.6 * (1 - np.array(normalized_contributions))
-        cluster_foods['score'] = combined_scores
+        # Contribution weights: each macro is weighted by its share of the remaining
+        # grams (0 when nothing of it remains)
+        remaining_pfc = np.array([remaining_macros['protein'], remaining_macros['fat'], remaining_macros['carbs']], dtype=np.float64)
+        weights = np.where(remaining_pfc > 0, remaining_pfc, 0.0) / total_pfc_grams
+        
+        combined_scores = _score_cluster(
+            self._cluster_X[predicted_cluster],
+            target_features[0],
+            self._macros[cluster_pos].astype(np.float64, copy=False),
+            weights
+        )
         
         # Step 9: Select final recommendations
-        if len(suitable_indices) >= n_recommendations:
+        if len(suitable_idx) >= n_recommendations:
             # Use only suitable foods
-            final_foods = cluster_foods.loc[suitable_indices].sort_values('score').head(n_recommendations)
+            candidate_idx = suitable_idx
         else:
             # If not enough suitable foods, use best overall (but still filtered for density)
-            final_foods = cluster_foods.sort_values('score').head(n_recommendations)
+            candidate_idx = np.arange(len(cluster_pos))
+        
+        # Partial selection of the k best scores, then sort only those k
+        candidate_scores = combined_scores[candidate_idx]
+        k = min(n_recommendations, len(candidate_idx))
+        if k > 0:
+            top = np.argpartition(candidate_scores, k - 1)[:k]
+            top = top[np.argsort(candidate_scores[top], kind='stable')]
+        else:
+            top = np.array([], dtype=np.intp)
+        final_pos = cluster_pos[candidate_idx[top]]
             
-        print(f"DEBUG: Top {len(final_foods)} recommendations after filtering:")
+        print(f"DEBUG: Top {len(final_pos)} recommendations after filtering:")
         
-        # Drop helper columns
+        # Build the output frame once, from the final positions only
         output_columns = ['Name', 'Category', 'kcal', 'protein', 'fat', 'carbs']
-        return final_foods[output_columns].reset_index(drop=True)
\ No newline at end of file
+        return self.data.iloc[final_pos][output_columns].reset_index(drop=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _load_engine(data_filepath: str, data_mtime: float) -> RecommendationEngine:
+    # data_mtime is only part of the cache key, so a modified file builds a new engine;
+    # one entry, so the engine for the outdated file is released
+    return RecommendationEngine(data_filepath)
+
+
+def get_engine(data_filepath: str) -> RecommendationEngine:
+    """
+    Return a warm RecommendationEngine for the given data file.
+    
+    The latest engine is memoized per process, so loading and model training
+    only happen on the first call (or after the data file changes). For use
+    outside Streamlit; the app keeps its own st.cache_resource entry.
+    """
+    return _load_engine(data_filepath, os.path.getmtime(data_filepath))
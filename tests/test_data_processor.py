@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.ml.data_processor import (
+    _compute_pct,
+    _read_processed_cache,
+    _write_processed_cache,
+    load_and_preprocess_data,
+)
+
+
+def test_compute_pct_zero_macros():
+    # A food without any macros gets 0 for every share instead of dividing by zero
+    macros = np.array([[0., 0, 0], [31, 3.6, 0]])
+    pct = _compute_pct(macros)
+    
+    assert (pct[0] == 0).all()
+    np.testing.assert_allclose(pct[1], [31 / 34.6, 3.6 / 34.6, 0])
+    np.testing.assert_allclose(pct[1].sum(), 1.0)
+    
+    # The input is left untouched
+    np.testing.assert_array_equal(macros, [[0, 0, 0], [31, 3.6, 0]])
+
+
+def test_compute_pct_integer_input():
+    pct = _compute_pct(np.array([[0, 0, 0], [31, 3, 0]]))
+    
+    assert pct.dtype == np.float64
+    assert (pct[0] == 0).all()
+    np.testing.assert_allclose(pct[1], [31 / 34, 3 / 34, 0])
+
+
+def test_load_and_preprocess_data_parquet(tmp_path):
+    # A Parquet source with the workbook's header columns is cleaned directly
+    parquet_file = tmp_path / "foods.parquet"
+    pd.DataFrame({
+        'Name': ['Chicken breast', 'Olive oil', 'Water', 'Rice'],
+        'Category': ['Meat', 'Oils', 'Drinks', 'Grains'],
+        'Energy, kilocalories (kcal)': [165.0, 884.0, 0.0, 130.0],
+        'Protein (g)': [31.0, 0.0, 0.0, 2.7],
+        'Fat, total (g)': [3.6, 100.0, 0.0, 0.3],
+        'Carbohydrates, available (g)': [0.0, 0.0, 0.0, 28.0],
+    }).to_parquet(parquet_file, compression=None)
+    
+    df, pipeline, X_features = load_and_preprocess_data(str(parquet_file))
+    
+    assert list(df['Name']) == ['Chicken breast', 'Olive oil', 'Water', 'Rice']
+    assert {'kcal', 'protein', 'fat', 'carbs'}.issubset(df.columns)
+    
+    pct = df[['protein_pct', 'fat_pct', 'carbs_pct']].to_numpy()
+    assert pct.dtype == np.float64
+    np.testing.assert_allclose(pct[0], [31 / 34.6, 3.6 / 34.6, 0])
+    assert (pct[2] == 0).all()
+    
+    assert X_features.shape == (4, 3)
+    assert 'preprocessor' in pipeline.named_steps
+    
+    # Parquet sources bypass the processed-data cache
+    assert list(tmp_path.glob("*.processed.*")) == []
+
+
+def test_processed_cache_roundtrip_and_fallbacks(tmp_path):
+    # The cleaned-data cache is only used for the exact workbook it was written from
+    workbook = tmp_path / "foods.xlsx"
+    workbook.write_bytes(b"workbook")
+    parquet_path = tmp_path / "foods.processed.parquet"
+    df = pd.DataFrame({'Name': ['Rice'], 'protein_pct': [0.1]})
+    
+    _write_processed_cache(df, parquet_path, workbook.stat())
+    # Written via a temporary file that is renamed into place
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["foods.processed.parquet", "foods.xlsx"]
+    pd.testing.assert_frame_equal(_read_processed_cache(parquet_path, workbook.stat()), df)
+    
+    # A workbook with an older mtime (e.g. copied in with cp -p) is not served stale data
+    os.utime(workbook, ns=(1, 1))
+    assert _read_processed_cache(parquet_path, workbook.stat()) is None
+    
+    # A truncated cache file is treated as missing instead of raising
+    parquet_path.write_bytes(parquet_path.read_bytes()[:20])
+    assert _read_processed_cache(parquet_path, workbook.stat()) is None